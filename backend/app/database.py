@@ -1,23 +1,37 @@
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import MetaData
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from app.config import settings
 
-# Sync engine for database operations (using psycopg2)
-# Convert asyncpg URL to psycopg2 URL
-db_url = settings.database_url.replace("postgresql+asyncpg://", "postgresql://")
-engine = create_engine(db_url, echo=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Async engine for database operations (using asyncpg)
+engine = create_async_engine(
+    settings.database_url,
+    echo=settings.debug,  # SQL logging only in debug mode
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True,  # Drop stale connections before use
+    pool_recycle=1800,  # Recycle connections every 30 minutes
+    pool_timeout=30
+)
+AsyncSessionLocal = async_sessionmaker(
+    bind=engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
 
 Base = declarative_base()
 metadata = MetaData()
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-def init_db():
-    Base.metadata.create_all(bind=engine) 
\ No newline at end of file
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+async def close_db():
+    await engine.dispose()
@@ -1,16 +1,19 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from contextlib import asynccontextmanager
+import asyncio
 import logging
 import os
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
+from arq import create_pool
+from arq.connections import RedisSettings
 
 from app.config import settings
-from app.database import init_db
+from app.database import init_db, close_db
+from app.rate_limit import rate_limiter
 from app.routers import upload, analysis
+from app.services.progress_service import progress_service
+from app.services.ai_service import ai_service
 
 # Configure logging
 logging.basicConfig(
@@ -26,25 +29,30 @@ os.makedirs(settings.upload_dir, exist_ok=True)
 async def lifespan(app: FastAPI):
     # Startup
     logger.info("Starting up...")
-    init_db()  # Call sync function without await
-    logger.info("Database initialized")
+    if settings.run_migrations_on_startup:
+        await init_db()
+        logger.info("Database initialized")
+    app.state.arq_pool = await create_pool(RedisSettings.from_dsn(settings.redis_url))
+    await ai_service.load_tokenizer()
+    sweep_task = asyncio.create_task(rate_limiter.sweep_forever())
     yield
     # Shutdown
     logger.info("Shutting down...")
+    sweep_task.cancel()
+    await app.state.arq_pool.aclose()
+    await close_db()
+    await progress_service.close()
+    await ai_service.close()
 
 # Create FastAPI app
 app = FastAPI(
     title="Document Upload & AI Analysis Platform",
     description="A platform for uploading documents and analyzing them with AI",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
-# Rate limiting
-limiter = Limiter(key_func=get_remote_address)
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
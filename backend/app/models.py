@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, Text, DateTime, Boolean, ForeignKey, JSON
+from sqlalchemy import Column, String, Integer, Text, DateTime, Boolean, ForeignKey, JSON, Index
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
@@ -8,16 +8,18 @@ from app.database import Base
 
 class Document(Base):
     __tablename__ = "documents"
+    __mapper_args__ = {"eager_defaults": True}  # Fetch server defaults via RETURNING
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     filename = Column(String(255), nullable=False)
     file_size = Column(Integer, nullable=False)
-    upload_time = Column(DateTime(timezone=True), server_default=func.now())
-    status = Column(String(50), default='uploaded')
+    upload_time = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    status = Column(String(50), default='uploaded', index=True)
     current_stage = Column(String(500))
     progress = Column(Integer, default=0)
     extracted_text = Column(Text)
     text_length = Column(Integer)
+    word_count = Column(Integer)
     language = Column(String(10))
     
     # Relationship with AI analyses
@@ -25,33 +27,39 @@ class Document(Base):
 
 class PromptTemplate(Base):
     __tablename__ = "prompt_templates"
+    __table_args__ = (
+        # Covers the public template list ordered by newest first
+        Index("ix_prompt_public_created", "is_public", "created_at"),
+    )
+    __mapper_args__ = {"eager_defaults": True}  # Fetch server defaults via RETURNING
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     name = Column(String(100), nullable=False)
     description = Column(Text)
     prompt_text = Column(Text, nullable=False)
-    category = Column(String(50))  # 'summary', 'analysis', 'extraction', 'custom'
+    category = Column(String(50), index=True)  # 'summary', 'analysis', 'extraction', 'custom'
     variables = Column(JSON)  # [{name: 'document_content', required: true}]
     example_output = Column(Text)
     usage_count = Column(Integer, default=0)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
-    is_public = Column(Boolean, default=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    is_public = Column(Boolean, default=True, index=True)
     
     # Relationship with AI analyses
     analyses = relationship("AIAnalysis", back_populates="prompt_template")
 
 class AIAnalysis(Base):
     __tablename__ = "ai_analyses"
+    __mapper_args__ = {"eager_defaults": True}  # Fetch server defaults via RETURNING
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    document_id = Column(UUID(as_uuid=True), ForeignKey("documents.id"), nullable=False)
+    document_id = Column(UUID(as_uuid=True), ForeignKey("documents.id"), nullable=False, index=True)
     prompt_template_id = Column(UUID(as_uuid=True), ForeignKey("prompt_templates.id"))
     final_prompt = Column(Text, nullable=False)  # Actual prompt sent to Gemini
     gemini_response = Column(Text)
     response_metadata = Column(JSON)  # tokens used, model, temperature
     execution_time_ms = Column(Integer)
     error_message = Column(Text)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     
     # Relationships
     document = relationship("Document", back_populates="analyses")
@@ -0,0 +1,69 @@
+import asyncio
+import ipaddress
+import time
+from fastapi import HTTPException, Request
+from app.config import settings
+
+class TokenBucket:
+    __slots__ = ("tokens", "t")
+
+    def __init__(self, tokens: float, t: float):
+        self.tokens = tokens
+        self.t = t  # Last refill time
+
+class RateLimiter:
+    """In-process token-bucket rate limiter keyed by packed client IP"""
+
+    def __init__(self, requests: int, window: int):
+        self.capacity = float(requests)
+        self.refill_rate = requests / window  # Tokens per second
+        self.window = window
+        self.buckets: dict[bytes, TokenBucket] = {}
+
+    def _key(self, host: str) -> bytes:
+        try:
+            return ipaddress.ip_address(host).packed
+        except ValueError:
+            return host.encode()
+
+    def hit(self, host: str) -> bool:
+        """Consume one token for host; return False if the limit is exceeded"""
+        now = time.monotonic()
+        key = self._key(host)
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.capacity, now)
+        else:
+            bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.t) * self.refill_rate)
+            bucket.t = now
+
+        if bucket.tokens < 1:
+            return False
+
+        bucket.tokens -= 1
+        return True
+
+    def sweep(self):
+        """Drop buckets that have been idle for more than two windows"""
+        cutoff = time.monotonic() - 2 * self.window
+        for key in [key for key, bucket in self.buckets.items() if bucket.t < cutoff]:
+            del self.buckets[key]
+
+    async def sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.window)
+            self.sweep()
+
+rate_limiter = RateLimiter(settings.rate_limit_requests, settings.rate_limit_window)
+
+async def rate_limit(request: Request):
+    """Dependency that rejects requests over the configured rate limit"""
+    host = request.client.host if request.client else ""
+
+    if not rate_limiter.hit(host):
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded. Please try again later.",
+            headers={"Retry-After": str(int(1 / rate_limiter.refill_rate) + 1)}
+        )
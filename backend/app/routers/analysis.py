@@ -1,18 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
-from sqlalchemy import select, update
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
+from sqlalchemy import select, insert, update, bindparam, func
+from typing import List, Optional
 import uuid
 import time
 import logging
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
 
 from app.database import get_db
+from app.rate_limit import rate_limit
 from app.models import Document, PromptTemplate, AIAnalysis
 from app.schemas import (
     PromptTemplate as PromptTemplateSchema,
+    PromptTemplateSummary,
     PromptTemplateCreate,
     PromptTemplateUpdate,
     AIAnalysis as AIAnalysisSchema,
@@ -20,39 +20,65 @@ from app.schemas import (
     AnalyzeDocumentResponse
 )
 from app.services.ai_service import ai_service
+from app.services.file_service import file_service
 from app.config import settings
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-# Rate limiting
-limiter = Limiter(key_func=get_remote_address)
+# Statements built once at import time and executed with bound parameters
+GET_TEMPLATE_BY_ID = select(PromptTemplate).where(PromptTemplate.id == bindparam("id"))
+TEMPLATE_EXISTS_BY_ID = (
+    select(PromptTemplate)
+    .options(load_only(PromptTemplate.id, PromptTemplate.is_public))
+    .where(PromptTemplate.id == bindparam("id"))
+)
+GET_ANALYSIS_BY_ID = select(AIAnalysis).where(AIAnalysis.id == bindparam("id"))
+GET_DOCUMENT_WITH_TEMPLATE = (
+    select(Document, PromptTemplate)
+    .join(PromptTemplate, PromptTemplate.id == bindparam("template_id"), isouter=True)
+    .where(Document.id == bindparam("document_id"))
+)
+INCREMENT_TEMPLATE_USAGE = (
+    update(PromptTemplate)
+    .where(PromptTemplate.id == bindparam("template_id"))
+    .values(usage_count=PromptTemplate.usage_count + 1)
+)
 
-@router.get("/prompt-templates", response_model=List[PromptTemplateSchema])
-def get_prompt_templates(
+@router.get("/prompt-templates", response_model=List[PromptTemplateSummary])
+async def get_prompt_templates(
     category: str = None,
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Get list of prompt templates"""
-    
-    stmt = select(PromptTemplate).where(PromptTemplate.is_public == True)
+    """Get list of prompt templates (full prompt text via /prompt-templates/{id})"""
+    
+    stmt = select(
+        PromptTemplate.id,
+        PromptTemplate.name,
+        PromptTemplate.description,
+        PromptTemplate.category,
+        # One extra character lets clients tell whether the preview was truncated
+        func.substr(PromptTemplate.prompt_text, 1, 151).label("prompt_preview"),
+        PromptTemplate.usage_count,
+        PromptTemplate.created_at
+    ).where(PromptTemplate.is_public == True)
     
     if category:
         stmt = stmt.where(PromptTemplate.category == category)
     
     stmt = stmt.offset(skip).limit(limit).order_by(PromptTemplate.created_at.desc())
     
-    result = db.execute(stmt)
-    templates = result.scalars().all()
+    result = await db.execute(stmt)
+    templates = result.mappings().all()
     
     return templates
 
 @router.post("/prompt-templates", response_model=PromptTemplateSchema)
-def create_prompt_template(
+async def create_prompt_template(
     template: PromptTemplateCreate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Create a new prompt template"""
     
@@ -67,25 +93,18 @@ def create_prompt_template(
     )
     
     db.add(db_template)
-    db.commit()
-    db.refresh(db_template)
+    await db.commit()
     
     return db_template
 
 @router.get("/prompt-templates/{template_id}", response_model=PromptTemplateSchema)
-def get_prompt_template(
-    template_id: str,
-    db: Session = Depends(get_db)
+async def get_prompt_template(
+    template_id: uuid.UUID,
+    db: AsyncSession = Depends(get_db)
 ):
     """Get specific prompt template"""
     
-    try:
-        template_uuid = uuid.UUID(template_id)
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid template ID format")
-    
-    stmt = select(PromptTemplate).where(PromptTemplate.id == template_uuid)
-    result = db.execute(stmt)
+    result = await db.execute(GET_TEMPLATE_BY_ID, {"id": template_id})
     template = result.scalar_one_or_none()
     
     if not template:
@@ -94,75 +113,71 @@ def get_prompt_template(
     return template
 
 @router.put("/prompt-templates/{template_id}", response_model=PromptTemplateSchema)
-def update_prompt_template(
-    template_id: str,
+async def update_prompt_template(
+    template_id: uuid.UUID,
     template_update: PromptTemplateUpdate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Update a prompt template"""
     
-    try:
-        template_uuid = uuid.UUID(template_id)
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid template ID format")
-    
-    stmt = select(PromptTemplate).where(PromptTemplate.id == template_uuid)
-    result = db.execute(stmt)
+    # Update fields that are provided and return the updated row in one round-trip
+    update_data = template_update.dict(exclude_unset=True)
+    if update_data:
+        stmt = (
+            update(PromptTemplate)
+            .where(PromptTemplate.id == template_id)
+            .values(**update_data)
+            .returning(PromptTemplate)
+        )
+        result = await db.execute(stmt)
+    else:
+        result = await db.execute(GET_TEMPLATE_BY_ID, {"id": template_id})
     template = result.scalar_one_or_none()
     
     if not template:
         raise HTTPException(status_code=404, detail="Prompt template not found")
     
-    # Update fields that are provided
-    update_data = template_update.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(template, field, value)
-    
-    db.commit()
-    db.refresh(template)
+    await db.commit()
     
     return template
 
 @router.delete("/prompt-templates/{template_id}")
-def delete_prompt_template(
-    template_id: str,
-    db: Session = Depends(get_db)
+async def delete_prompt_template(
+    template_id: uuid.UUID,
+    db: AsyncSession = Depends(get_db)
 ):
     """Delete a prompt template"""
     
-    try:
-        template_uuid = uuid.UUID(template_id)
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid template ID format")
-    
-    stmt = select(PromptTemplate).where(PromptTemplate.id == template_uuid)
-    result = db.execute(stmt)
+    result = await db.execute(TEMPLATE_EXISTS_BY_ID, {"id": template_id})
     template = result.scalar_one_or_none()
     
     if not template:
         raise HTTPException(status_code=404, detail="Prompt template not found")
     
-    db.delete(template)
-    db.commit()
+    await db.delete(template)
+    await db.commit()
     
     return {"message": "Prompt template deleted successfully"}
 
-@router.post("/analyze", response_model=AnalyzeDocumentResponse)
-# @limiter.limit(f"{settings.rate_limit_requests}/minute")  # Temporarily disabled
-def analyze_document(
+@router.post("/analyze", response_model=AnalyzeDocumentResponse, dependencies=[Depends(rate_limit)])
+async def analyze_document(
     request_data: AnalyzeDocumentRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Analyze a document with given prompt"""
     
-    # Get document
-    stmt = select(Document).where(Document.id == request_data.document_id)
-    result = db.execute(stmt)
-    document = result.scalar_one_or_none()
+    # Get document and prompt template (if provided) in a single query
+    result = await db.execute(
+        GET_DOCUMENT_WITH_TEMPLATE,
+        {"document_id": request_data.document_id, "template_id": request_data.prompt_template_id}
+    )
+    row = result.one_or_none()
     
-    if not document:
+    if not row:
         raise HTTPException(status_code=404, detail="Document not found")
     
+    document, prompt_template = row
+    
     if document.status != "ready":
         raise HTTPException(
             status_code=400, 
@@ -172,19 +187,12 @@ def analyze_document(
     if not document.extracted_text:
         raise HTTPException(status_code=400, detail="Document has no extracted text")
     
-    # Get prompt template if provided
-    prompt_template = None
     if request_data.prompt_template_id:
-        stmt = select(PromptTemplate).where(PromptTemplate.id == request_data.prompt_template_id)
-        result = db.execute(stmt)
-        prompt_template = result.scalar_one_or_none()
-        
         if not prompt_template:
             raise HTTPException(status_code=404, detail="Prompt template not found")
         
-        # Update usage count
-        prompt_template.usage_count += 1
-        db.commit()
+        # Update usage count atomically in the same transaction as the analysis insert
+        await db.execute(INCREMENT_TEMPLATE_USAGE, {"template_id": request_data.prompt_template_id})
     
     # Create AI analysis record
     analysis = AIAnalysis(
@@ -194,14 +202,19 @@ def analyze_document(
     )
     
     db.add(analysis)
-    db.commit()
-    db.refresh(analysis)
+    await db.commit()
     
     try:
         # For now, return a simple response since AI service needs to be implemented
         # This will allow testing the analysis endpoint
         
         start_time = time.time()
+        
+        # Word count is stored at extraction time; count on the fly for older documents
+        tokens_used = document.word_count
+        if tokens_used is None:
+            tokens_used = file_service.count_words(document.extracted_text)
+        
         execution_time = int((time.time() - start_time) * 1000)
         
         # Simple mock response for testing
@@ -212,66 +225,56 @@ def analyze_document(
         analysis.execution_time_ms = execution_time
         analysis.response_metadata = {
             "model": "mock-model",
-            "tokens_used": len(document.extracted_text.split()),
+            "tokens_used": tokens_used,
             "chunks_processed": 1
         }
         
-        db.commit()
+        await db.commit()
         
         return AnalyzeDocumentResponse(
             analysis_id=analysis.id,
             response=mock_response,
             execution_time_ms=execution_time,
-            tokens_used=len(document.extracted_text.split())
+            tokens_used=tokens_used
         )
         
     except Exception as e:
         # Update analysis record with error
         analysis.error_message = str(e)
-        db.commit()
+        await db.commit()
         
         logger.error(f"Analysis failed for document {request_data.document_id}: {e}")
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
 @router.get("/analyses", response_model=List[AIAnalysisSchema])
-def get_analyses(
-    document_id: str = None,
+async def get_analyses(
+    document_id: Optional[uuid.UUID] = None,
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get list of AI analyses"""
     
     stmt = select(AIAnalysis)
     
     if document_id:
-        try:
-            doc_uuid = uuid.UUID(document_id)
-            stmt = stmt.where(AIAnalysis.document_id == doc_uuid)
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid document ID format")
+        stmt = stmt.where(AIAnalysis.document_id == document_id)
     
     stmt = stmt.offset(skip).limit(limit).order_by(AIAnalysis.created_at.desc())
     
-    result = db.execute(stmt)
+    result = await db.execute(stmt)
     analyses = result.scalars().all()
     
     return analyses
 
 @router.get("/analyses/{analysis_id}", response_model=AIAnalysisSchema)
-def get_analysis(
-    analysis_id: str,
-    db: Session = Depends(get_db)
+async def get_analysis(
+    analysis_id: uuid.UUID,
+    db: AsyncSession = Depends(get_db)
 ):
     """Get specific AI analysis"""
     
-    try:
-        analysis_uuid = uuid.UUID(analysis_id)
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid analysis ID format")
-    
-    stmt = select(AIAnalysis).where(AIAnalysis.id == analysis_uuid)
-    result = db.execute(stmt)
+    result = await db.execute(GET_ANALYSIS_BY_ID, {"id": analysis_id})
     analysis = result.scalar_one_or_none()
     
     if not analysis:
@@ -280,12 +283,12 @@ def get_analysis(
     return analysis
 
 @router.post("/init-default-templates")
-def initialize_default_templates(db: Session = Depends(get_db)):
+async def initialize_default_templates(db: AsyncSession = Depends(get_db)):
     """Initialize default prompt templates"""
     
     # Check if templates already exist
     stmt = select(PromptTemplate).limit(1)
-    result = db.execute(stmt)
+    result = await db.execute(stmt)
     existing = result.scalar_one_or_none()
     
     if existing:
@@ -294,20 +297,23 @@ def initialize_default_templates(db: Session = Depends(get_db)):
     # Create default templates
     default_templates = ai_service.get_default_prompts()
     
-    for template_data in default_templates:
-        template = PromptTemplate(
-            name=template_data["name"],
-            description=template_data["description"],
-            prompt_text=template_data["prompt_text"],
-            category=template_data["category"],
-            variables=template_data["variables"],
-            example_output=template_data["example_output"],
-            is_public=True
-        )
-        db.add(template)
-    
-    db.commit()
+    # Insert all templates with a single multi-row INSERT
+    await db.execute(
+        insert(PromptTemplate),
+        [
+            {
+                "name": template_data["name"],
+                "description": template_data["description"],
+                "prompt_text": template_data["prompt_text"],
+                "category": template_data["category"],
+                "variables": template_data["variables"],
+                "example_output": template_data["example_output"],
+                "is_public": True
+            }
+            for template_data in default_templates
+        ]
+    )
+    await db.commit()
     
     return {"message": f"Created {len(default_templates)} default templates"}
-
-# Rate limit exception handler is already registered in main.py 
\ No newline at end of file
+ 
\ No newline at end of file
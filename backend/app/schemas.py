@@ -17,21 +17,26 @@ class DocumentUpdate(BaseModel):
     progress: Optional[int] = None
     extracted_text: Optional[str] = None
     text_length: Optional[int] = None
+    word_count: Optional[int] = None
     language: Optional[str] = None
 
-class Document(DocumentBase):
+class DocumentSummary(DocumentBase):
+    """Document fields for list views (without extracted text)"""
     id: uuid.UUID
     upload_time: datetime
     status: str
     current_stage: Optional[str] = None
     progress: int
-    extracted_text: Optional[str] = None
     text_length: Optional[int] = None
+    word_count: Optional[int] = None
     language: Optional[str] = None
     
     class Config:
         from_attributes = True
 
+class Document(DocumentSummary):
+    extracted_text: Optional[str] = None
+
 # Prompt Template schemas
 class PromptTemplateBase(BaseModel):
     name: str
@@ -62,6 +67,19 @@ class PromptTemplate(PromptTemplateBase):
     class Config:
         from_attributes = True
 
+class PromptTemplateSummary(BaseModel):
+    """Prompt template fields for list views (prompt text truncated to a preview)"""
+    id: uuid.UUID
+    name: str
+    description: Optional[str] = None
+    category: Optional[str] = None
+    prompt_preview: str
+    usage_count: int
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
 # AI Analysis schemas
 class AIAnalysisBase(BaseModel):
     document_id: uuid.UUID
@@ -1,17 +1,138 @@
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import time
+import threading
 import asyncio
-import hashlib
-import json
-from typing import Optional, Dict, Any
+import codecs
+import orjson
+import numpy as np
+import tiktoken
+import xxhash
+from typing import Optional, Dict, Any, Union
 from fastapi import HTTPException
 from app.config import settings
 import logging
-import redis
-from tenacity import retry, stop_after_attempt, wait_exponential
+import redis.asyncio as aioredis
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
 logger = logging.getLogger(__name__)
 
+# Gemini errors worth retrying: rate limiting (429, incl. quota), server-side failures (5xx) and timeouts
+TRANSIENT_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServerError,
+    asyncio.TimeoutError,
+    ConnectionError,
+)
+
+# Separator between the prompt and the document; the SDK joins text parts without one
+DOCUMENT_SEPARATOR = "\n\nDocument:\n"
+
+# Documents above this many tokens are analyzed in chunks of this size
+MAX_CHUNK_TOKENS = 4000
+
+# Jittered backoff keeps concurrent chunk calls from retrying in lockstep against the rate limit
+_retrier = AsyncRetrying(
+    retry=retry_if_exception_type(TRANSIENT_ERRORS),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential_jitter(initial=1, max=10),
+    reraise=True
+)
+
+class CircuitBreaker:
+    """Fail fast after repeated failures until a cool-down period has passed"""
+    
+    def __init__(self, fail_max: int, reset_timeout: float):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+    
+    def allow(self) -> bool:
+        """Return False while open; once the cool-down has passed let a single probe call through"""
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self.probing = True
+        return True
+    
+    def end_probe(self):
+        """Free the probe slot; a probe without a verdict (e.g. cancelled) lets the next call probe"""
+        self.probing = False
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.fail_max:
+            self.opened_at = time.monotonic()
+
+# Seconds to wait for the tokenizer; tiktoken's first load downloads the BPE file without a timeout
+TOKENIZER_LOAD_TIMEOUT = 10
+
+# Set only once a load succeeds, so a failed download is retried by the next load_tokenizer()
+_encoding: Optional[tiktoken.Encoding] = None
+_encoding_lock = threading.Lock()
+
+def _get_encoding() -> Optional[tiktoken.Encoding]:
+    """Load the BPE tokenizer used for token counting, or None if it is unavailable"""
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                logger.warning(f"Tokenizer unavailable, falling back to word-length estimates: {e}")
+        return _encoding
+
+# Built once at import; callers must treat these as read-only
+_DEFAULT_PROMPTS: tuple[Dict[str, Any], ...] = (
+    {
+        "name": "Executive Summary",
+        "category": "summary",
+        "description": "Generate a concise executive summary",
+        "prompt_text": "Provide a concise executive summary of the following document in 3-5 bullet points: {document_content}",
+        "variables": [{"name": "document_content", "required": True}],
+        "example_output": "• Key finding 1\n• Key finding 2\n• Key finding 3"
+    },
+    {
+        "name": "Key Insights",
+        "category": "analysis",
+        "description": "Extract the most important insights",
+        "prompt_text": "Analyze this document and extract the 5 most important insights: {document_content}",
+        "variables": [{"name": "document_content", "required": True}],
+        "example_output": "1. Insight 1\n2. Insight 2\n3. Insight 3\n4. Insight 4\n5. Insight 5"
+    },
+    {
+        "name": "Action Items",
+        "category": "extraction",
+        "description": "List all action items and tasks",
+        "prompt_text": "List all action items, tasks, or next steps mentioned in this document: {document_content}",
+        "variables": [{"name": "document_content", "required": True}],
+        "example_output": "• Action item 1\n• Action item 2\n• Action item 3"
+    },
+    {
+        "name": "Financial Figures",
+        "category": "extraction",
+        "description": "Extract financial data and numbers",
+        "prompt_text": "Extract all financial figures, amounts, and percentages from this document: {document_content}",
+        "variables": [{"name": "document_content", "required": True}],
+        "example_output": "$1,000,000 - Revenue\n25% - Growth rate\n$500,000 - Profit"
+    },
+    {
+        "name": "Sentiment Analysis",
+        "category": "analysis",
+        "description": "Analyze the sentiment and tone",
+        "prompt_text": "Analyze the sentiment and overall tone of this document. Is it positive, negative, or neutral? Explain your reasoning: {document_content}",
+        "variables": [{"name": "document_content", "required": True}],
+        "example_output": "Sentiment: Positive\nReasoning: The document contains optimistic language..."
+    }
+)
+
 class AIService:
     def __init__(self):
         if not settings.gemini_api_key:
@@ -21,17 +142,29 @@ class AIService:
             genai.configure(api_key=settings.gemini_api_key)
             self.model = genai.GenerativeModel('gemini-pro')
         
+        # Bound concurrent Gemini calls to respect API rate limits
+        self._sem = asyncio.Semaphore(settings.gemini_concurrency or 4)
+        
+        # Shed load quickly while Gemini is failing
+        self._breaker = CircuitBreaker(fail_max=5, reset_timeout=30)
+        
         # Redis for caching
         try:
-            self.redis_client = redis.from_url(settings.redis_url)
+            self.redis_client = aioredis.from_url(settings.redis_url, decode_responses=False)
         except Exception as e:
             logger.warning(f"Redis connection failed: {e}")
             self.redis_client = None
     
-    def _generate_cache_key(self, prompt: str, document_text: str) -> str:
+    def _hash_text(self, text: str) -> str:
+        """Content hash used to address cached documents"""
+        return xxhash.xxh3_64_hexdigest(text.encode())
+    
+    def _generate_cache_key(self, prompt: str, document_text: str = "", doc_hash: Optional[str] = None) -> str:
         """Generate cache key for prompt + document combination"""
-        content = f"{prompt}:{document_text}"
-        return f"gemini_cache:{hashlib.md5(content.encode()).hexdigest()}"
+        # Prompt and document are hashed separately so a document hashed once can be reused across prompts
+        if doc_hash is None:
+            doc_hash = self._hash_text(document_text)
+        return f"gemini:{self._hash_text(prompt)}:{doc_hash}"
     
     async def _get_cached_response(self, cache_key: str) -> Optional[Dict[str, Any]]:
         """Get cached response from Redis"""
@@ -39,9 +172,9 @@ class AIService:
             return None
         
         try:
-            cached = self.redis_client.get(cache_key)
+            cached = await self.redis_client.get(cache_key)
             if cached:
-                return json.loads(cached)
+                return orjson.loads(cached)
         except Exception as e:
             logger.warning(f"Cache read error: {e}")
         
@@ -53,54 +186,140 @@ class AIService:
             return
         
         try:
-            self.redis_client.setex(
+            await self.redis_client.setex(
                 cache_key, 
                 ttl, 
-                json.dumps(response_data)
+                orjson.dumps(response_data)
             )
         except Exception as e:
             logger.warning(f"Cache write error: {e}")
     
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=4, max=10)
-    )
-    async def _call_gemini_api(self, prompt: str) -> Dict[str, Any]:
-        """Call Gemini API with retry logic"""
+    async def _mget_cached(self, keys: list[str]) -> list[Optional[Dict[str, Any]]]:
+        """Get cached responses for several keys in one round trip"""
+        if not self.redis_client or not keys:
+            return [None] * len(keys)
+        
+        try:
+            values = await self.redis_client.mget(keys)
+            return [orjson.loads(value) if value else None for value in values]
+        except Exception as e:
+            logger.warning(f"Cache read error: {e}")
+        
+        return [None] * len(keys)
+    
+    async def _cache_responses(self, items: list[tuple[str, Dict[str, Any]]], ttl: int = 3600):
+        """Cache several responses in one pipelined round trip"""
+        if not self.redis_client or not items:
+            return
+        
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for cache_key, response_data in items:
+                    pipe.setex(cache_key, ttl, orjson.dumps(response_data))
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Cache write error: {e}")
+    
+    def _tokenize(self, text: str) -> Optional[np.ndarray]:
+        """Encode text to BPE token ids"""
+        encoding = _encoding
+        if encoding is None:
+            return None
+        return np.array(encoding.encode_ordinary(text), dtype=np.uint32)
+    
+    def _count_tokens(self, text: str) -> int:
+        """Count BPE tokens, estimating ~4 characters per token without the tokenizer"""
+        token_ids = self._tokenize(text)
+        return len(token_ids) if token_ids is not None else len(text) // 4
+    
+    async def _get_token_ids(
+        self,
+        text: str,
+        doc_hash: Optional[str] = None,
+        ttl: int = 3600
+    ) -> Optional[np.ndarray]:
+        """Get BPE token ids for text, cached in Redis by content hash"""
+        if await self.load_tokenizer() is None:
+            return None
+        
+        cache_key = f"gemini_tokens:{doc_hash or self._hash_text(text)}"
+        
+        if self.redis_client:
+            try:
+                cached = await self.redis_client.get(cache_key)
+                if cached is not None:
+                    return np.frombuffer(cached, dtype=np.uint32)
+            except Exception as e:
+                logger.warning(f"Cache read error: {e}")
+        
+        token_ids = await asyncio.to_thread(self._tokenize, text)
+        
+        if self.redis_client:
+            try:
+                await self.redis_client.setex(cache_key, ttl, token_ids.tobytes())
+            except Exception as e:
+                logger.warning(f"Cache write error: {e}")
+        
+        return token_ids
+    
+    async def load_tokenizer(self) -> Optional[tiktoken.Encoding]:
+        """Load the tokenizer off the event loop; the first load may download the BPE file"""
+        if _encoding is not None:
+            return _encoding
+        try:
+            return await asyncio.wait_for(asyncio.to_thread(_get_encoding), TOKENIZER_LOAD_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Tokenizer load timed out after {TOKENIZER_LOAD_TIMEOUT}s, using word-length estimates")
+            return None
+    
+    async def close(self):
+        if self.redis_client:
+            await self.redis_client.aclose()
+    
+    async def _generate(self, parts: Union[list[str], str]):
+        """Call generate_content in the thread pool, retrying transient errors"""
+        loop = asyncio.get_event_loop()
+        # AsyncRetrying keeps per-run state on the instance, so each call iterates its own copy
+        async for attempt in _retrier.copy():
+            with attempt:
+                async with self._sem:
+                    return await loop.run_in_executor(
+                        None,
+                        lambda: self.model.generate_content(
+                            parts,
+                            request_options={"timeout": settings.gemini_timeout}
+                        )
+                    )
+    
+    async def _call_gemini_api(
+        self,
+        parts: Union[list[str], str],
+        prompt_tokens: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Call Gemini API with retry logic; prompt_tokens is used when the API reports no usage"""
         if not self.model:
             raise HTTPException(
                 status_code=503,
                 detail="Gemini API not configured. Please set GEMINI_API_KEY environment variable."
             )
         
+        if not self._breaker.allow():
+            raise HTTPException(
+                status_code=503,
+                detail="AI service temporarily unavailable. Please try again later."
+            )
+        probe = self._breaker.probing
+        
         start_time = time.time()
         
         try:
-            # Run in thread pool to avoid blocking
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: self.model.generate_content(prompt)
-            )
-            
-            execution_time = int((time.time() - start_time) * 1000)
-            
-            if not response or not response.text:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Empty response from Gemini API"
-                )
-            
-            return {
-                "response": response.text,
-                "execution_time_ms": execution_time,
-                "model": "gemini-pro",
-                "tokens_used": len(prompt.split()) + len(response.text.split()),  # Rough estimate
-            }
-            
+            response = await self._generate(parts)
         except Exception as e:
             logger.error(f"Gemini API error: {e}")
-            if "quota" in str(e).lower() or "rate limit" in str(e).lower():
+            if isinstance(e, TRANSIENT_ERRORS):
+                self._breaker.record_failure()
+            
+            if isinstance(e, google_exceptions.TooManyRequests) or "quota" in str(e).lower() or "rate limit" in str(e).lower():
                 raise HTTPException(
                     status_code=429,
                     detail="API rate limit exceeded. Please try again later."
@@ -115,56 +334,127 @@ class AIService:
                     status_code=500,
                     detail=f"AI service error: {str(e)}"
                 )
+        else:
+            # Gemini answered, even if the response turns out to be blocked
+            self._breaker.record_success()
+        finally:
+            if probe:
+                self._breaker.end_probe()
+        
+        execution_time = int((time.time() - start_time) * 1000)
+        
+        # response.text raises ValueError for blocked or candidate-less responses
+        try:
+            text = response.text if response else None
+        except ValueError as e:
+            logger.error(f"Gemini API returned no usable text: {e}")
+            text = None
+        
+        if not text:
+            raise HTTPException(
+                status_code=500,
+                detail="Empty or blocked response from Gemini API"
+            )
+        
+        # Prefer exact counts from the API; otherwise estimate ~4 characters per token
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            prompt_tokens = usage.prompt_token_count
+            completion_tokens = usage.candidates_token_count
+        else:
+            if prompt_tokens is None:
+                prompt_tokens = (len(parts) if isinstance(parts, str) else sum(map(len, parts))) // 4
+            completion_tokens = len(text) // 4
+        
+        return {
+            "response": text,
+            "execution_time_ms": execution_time,
+            "model": "gemini-pro",
+            "tokens_used": prompt_tokens + completion_tokens,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+        }
     
     async def analyze_document(
         self, 
         prompt: str, 
         document_text: str,
-        use_cache: bool = True
+        use_cache: bool = True,
+        document_tokens: Optional[int] = None,
+        doc_hash: Optional[str] = None
     ) -> Dict[str, Any]:
         """Analyze document with given prompt"""
         
-        # Generate full prompt
-        full_prompt = f"{prompt}\n\nDocument:\n{document_text}"
+        # Check cache first; the key is computed once and reused for the write
+        cache_key = self._generate_cache_key(prompt, document_text, doc_hash=doc_hash) if use_cache else None
+        if cache_key and (cached_response := await self._get_cached_response(cache_key)):
+            logger.info("Returning cached response")
+            return cached_response
         
-        # Check cache first
-        if use_cache:
-            cache_key = self._generate_cache_key(prompt, document_text)
-            cached_response = await self._get_cached_response(cache_key)
-            if cached_response:
-                logger.info("Returning cached response")
-                return cached_response
+        # Reuse the caller's document token count if known
+        prompt_tokens = None
+        if document_tokens is not None:
+            prompt_tokens = self._count_tokens(prompt) + self._count_tokens(DOCUMENT_SEPARATOR) + document_tokens
         
-        # Call Gemini API
-        response_data = await self._call_gemini_api(full_prompt)
+        # Call Gemini API with prompt and document as separate parts rather than one concatenated string
+        response_data = await self._call_gemini_api(
+            [prompt, DOCUMENT_SEPARATOR, document_text],
+            prompt_tokens=prompt_tokens
+        )
         
         # Cache the response
-        if use_cache:
+        if cache_key:
             await self._cache_response(cache_key, response_data)
         
         return response_data
     
-    async def chunk_document(self, text: str, max_tokens: int = 4000) -> list[str]:
+    def chunk_document(
+        self,
+        text: str,
+        max_tokens: int = MAX_CHUNK_TOKENS,
+        token_ids: Optional[np.ndarray] = None
+    ) -> list[str]:
         """Chunk document for large texts that exceed token limits"""
+        encoding = _encoding
+        if encoding is None:
+            return self._chunk_by_word_length(text, max_tokens)
+        
+        if token_ids is None:
+            token_ids = self._tokenize(text)
+        
+        # Slice the token ids into windows and decode each back to text. A window edge can fall
+        # inside a multi-byte character, so an incremental decoder carries partial bytes forward.
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        starts = range(0, len(token_ids), max_tokens)
+        return [
+            decoder.decode(
+                encoding.decode_bytes(token_ids[start:start + max_tokens].tolist()),
+                final=start == starts[-1]
+            )
+            for start in starts
+        ]
+    
+    def _chunk_by_word_length(self, text: str, max_tokens: int) -> list[str]:
+        """Chunk document by estimated tokens when the tokenizer is unavailable"""
         words = text.split()
-        chunks = []
-        current_chunk = []
-        current_length = 0
+        if not words:
+            return []
         
-        for word in words:
-            # Rough token estimation (1 token ≈ 0.75 words)
-            word_tokens = len(word) / 0.75
-            
-            if current_length + word_tokens > max_tokens and current_chunk:
-                chunks.append(" ".join(current_chunk))
-                current_chunk = [word]
-                current_length = word_tokens
-            else:
-                current_chunk.append(word)
-                current_length += word_tokens
+        # Rough token estimation (1 token ≈ 0.75 words): a chunk holds max_tokens * 0.75 characters
+        lens = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+        cum_chars = np.cumsum(lens)
+        max_chars = int(max_tokens * 0.75)  # Word lengths are integers, so flooring the limit is exact
         
-        if current_chunk:
-            chunks.append(" ".join(current_chunk))
+        chunks = []
+        start = 0
+        consumed = 0
+        while start < len(words):
+            # Greedily take every following word that still fits in this chunk (always at least one)
+            end = int(np.searchsorted(cum_chars, consumed + max_chars, side="right"))
+            end = max(end, start + 1)
+            chunks.append(" ".join(words[start:end]))
+            consumed = int(cum_chars[end - 1])
+            start = end
         
         return chunks
     
@@ -175,24 +465,69 @@ class AIService:
     ) -> Dict[str, Any]:
         """Analyze large documents by chunking"""
         
+        # Hash the document once for both the token and response caches
+        doc_hash = self._hash_text(document_text)
+        token_ids = await self._get_token_ids(document_text, doc_hash=doc_hash)
+        
         # Check if document needs chunking
-        estimated_tokens = len(document_text.split()) * 1.33  # Rough estimation
+        if token_ids is not None:
+            token_count = len(token_ids)
+        else:
+            token_count = len(document_text.split()) * 1.33  # Rough estimation
         
-        if estimated_tokens <= 4000:
-            return await self.analyze_document(prompt, document_text)
+        if token_count <= MAX_CHUNK_TOKENS:
+            return await self.analyze_document(
+                prompt,
+                document_text,
+                document_tokens=int(token_count),
+                doc_hash=doc_hash
+            )
         
         # Chunk the document
-        chunks = await self.chunk_document(document_text)
+        chunks = self.chunk_document(document_text, token_ids=token_ids)
+        
+        chunk_headers = [
+            f"\n\nThis is part {i+1} of {len(chunks)} of the document. Please analyze this section:\n\n"
+            for i in range(len(chunks))
+        ]
+        chunk_parts = [[prompt, header, chunk] for header, chunk in zip(chunk_headers, chunks)]
         
-        # Analyze each chunk
-        chunk_results = []
-        total_execution_time = 0
+        # Look up all chunk results in a single MGET
+        cache_keys = [
+            f"{self._generate_cache_key(prompt, chunk)}:{i+1}/{len(chunks)}"
+            for i, chunk in enumerate(chunks)
+        ]
+        results = await self._mget_cached(cache_keys)
+        misses = [i for i, result in enumerate(results) if result is None]
+        
+        # Token windows are full except the last one; without the tokenizer let the API call count
+        if token_ids is not None:
+            prompt_count = self._count_tokens(prompt)
+            chunk_tokens = [
+                prompt_count + self._count_tokens(header) + min(MAX_CHUNK_TOKENS, len(token_ids) - start)
+                for header, start in zip(chunk_headers, range(0, len(token_ids), MAX_CHUNK_TOKENS))
+            ]
+        else:
+            chunk_tokens = [None] * len(chunks)
         
-        for i, chunk in enumerate(chunks):
-            chunk_prompt = f"{prompt}\n\nThis is part {i+1} of {len(chunks)} of the document. Please analyze this section:\n\n{chunk}"
-            result = await self.analyze_document(chunk_prompt, "", use_cache=False)
-            chunk_results.append(result["response"])
-            total_execution_time += result["execution_time_ms"]
+        # Analyze uncached chunks concurrently (bounded by the API semaphore). Let every call
+        # finish so the chunks that succeeded are cached and a retry only re-sends the failures.
+        fresh = await asyncio.gather(*(
+            self._call_gemini_api(chunk_parts[i], prompt_tokens=chunk_tokens[i]) for i in misses
+        ), return_exceptions=True)
+        for i, result in zip(misses, fresh):
+            results[i] = result
+        
+        await self._cache_responses([
+            (cache_keys[i], results[i]) for i in misses if not isinstance(results[i], BaseException)
+        ])
+        
+        for result in fresh:
+            if isinstance(result, BaseException):
+                raise result
+        
+        chunk_results = [result["response"] for result in results]
+        total_execution_time = sum(result["execution_time_ms"] for result in results)
         
         # Combine results
         combined_prompt = f"Please synthesize the following {len(chunks)} analysis results into a cohesive summary:\n\n"
@@ -205,49 +540,8 @@ class AIService:
         
         return final_result
     
-    def get_default_prompts(self) -> list[Dict[str, Any]]:
+    def get_default_prompts(self) -> tuple[Dict[str, Any], ...]:
         """Get default prompt templates"""
-        return [
-            {
-                "name": "Executive Summary",
-                "category": "summary",
-                "description": "Generate a concise executive summary",
-                "prompt_text": "Provide a concise executive summary of the following document in 3-5 bullet points: {document_content}",
-                "variables": [{"name": "document_content", "required": True}],
-                "example_output": "• Key finding 1\n• Key finding 2\n• Key finding 3"
-            },
-            {
-                "name": "Key Insights",
-                "category": "analysis",
-                "description": "Extract the most important insights",
-                "prompt_text": "Analyze this document and extract the 5 most important insights: {document_content}",
-                "variables": [{"name": "document_content", "required": True}],
-                "example_output": "1. Insight 1\n2. Insight 2\n3. Insight 3\n4. Insight 4\n5. Insight 5"
-            },
-            {
-                "name": "Action Items",
-                "category": "extraction",
-                "description": "List all action items and tasks",
-                "prompt_text": "List all action items, tasks, or next steps mentioned in this document: {document_content}",
-                "variables": [{"name": "document_content", "required": True}],
-                "example_output": "• Action item 1\n• Action item 2\n• Action item 3"
-            },
-            {
-                "name": "Financial Figures",
-                "category": "extraction",
-                "description": "Extract financial data and numbers",
-                "prompt_text": "Extract all financial figures, amounts, and percentages from this document: {document_content}",
-                "variables": [{"name": "document_content", "required": True}],
-                "example_output": "$1,000,000 - Revenue\n25% - Growth rate\n$500,000 - Profit"
-            },
-            {
-                "name": "Sentiment Analysis",
-                "category": "analysis",
-                "description": "Analyze the sentiment and tone",
-                "prompt_text": "Analyze the sentiment and overall tone of this document. Is it positive, negative, or neutral? Explain your reasoning: {document_content}",
-                "variables": [{"name": "document_content", "required": True}],
-                "example_output": "Sentiment: Positive\nReasoning: The document contains optimistic language..."
-            }
-        ]
+        return _DEFAULT_PROMPTS
 
 ai_service = AIService() 
\ No newline at end of file
@@ -1,5 +1,8 @@
 import os
+import re
+import multiprocessing
 import aiofiles
+import fitz
 import PyPDF2
 import pdfplumber
 from typing import Optional
@@ -7,8 +10,50 @@ from fastapi import UploadFile, HTTPException
 from app.config import settings
 import uuid
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+try:
+    import gcld3
+except ImportError:  # Optional native language detector
+    gcld3 = None
+
+_cld3 = (
+    gcld3.NNetLanguageIdentifier(min_num_bytes=0, max_num_bytes=1000)
+    if gcld3 is not None and settings.cld3_language_detection else None
+)
+
+# Common English words used by the language detection heuristic
+_EN_WORDS = frozenset({"the", "and", "or", "but", "in", "on", "at", "to", "for", "of", "with", "by"})
+
+# PDFs up to this many pages are parsed in-process; larger ones are sharded across the pool
+PARALLEL_PDF_MIN_PAGES = 10
+
+# pdfplumber page parsing is CPU-bound, so spread it over processes rather than threads.
+# forkserver avoids forking a parent that already runs event loop and executor threads.
+# Created on first use so importers that never shard a PDF don't spawn the forkserver.
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """Return the shared PDF extraction pool, creating it on first use"""
+    global _pdf_pool
+    if _pdf_pool is None:
+        _pdf_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count() or 1,
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+    return _pdf_pool
+
+def _extract_page_range(file_path: str, start: int, end: int) -> str:
+    """Extract text from pages [start, end) of a PDF using pdfplumber"""
+    text = ""
+    with pdfplumber.open(file_path, pages=range(start + 1, end + 1)) as pdf:
+        for page in pdf.pages:
+            page_text = page.extract_text()
+            if page_text:
+                text += page_text + "\n"
+    return text
+
 class FileService:
     def __init__(self):
         self.upload_dir = Path(settings.upload_dir)
@@ -24,10 +69,11 @@ class FileService:
                 detail=f"File type not allowed. Allowed types: {', '.join(settings.allowed_extensions)}"
             )
         
-        # Check file size
-        file.file.seek(0, 2)  # Seek to end
-        file_size = file.file.tell()
-        file.file.seek(0)  # Reset to beginning
+        # Check file size: Starlette records it while parsing the upload
+        file_size = file.size
+        if file_size is None:
+            # fstat would force an in-memory spooled file to roll over to disk, so seek instead
+            file_size = file.file.seek(0, 2)  # save_file rewinds before copying
         
         if file_size > settings.max_file_size:
             raise HTTPException(
@@ -37,16 +83,23 @@ class FileService:
         
         return True
     
-    async def save_file(self, file: UploadFile, file_id: uuid.UUID) -> str:
-        """Save uploaded file to disk"""
+    async def save_file(self, file: UploadFile, file_id: uuid.UUID) -> tuple[str, int]:
+        """Copy uploaded file to disk, returning its path and size"""
         file_ext = Path(file.filename).suffix.lower()
         file_path = self.upload_dir / f"{file_id}{file_ext}"
+        await file.seek(0)
         
-        async with aiofiles.open(file_path, 'wb') as f:
-            content = await file.read()
-            await f.write(content)
+        def copy_file() -> int:
+            # Copy in one worker thread rather than hopping to the pool for every chunk
+            file_size = 0
+            with open(file_path, 'wb') as dst:
+                while chunk := file.file.read(1024 * 1024):
+                    dst.write(chunk)
+                    file_size += len(chunk)
+            return file_size
         
-        return str(file_path)
+        file_size = await asyncio.to_thread(copy_file)
+        return str(file_path), file_size
     
     def extract_text(self, file_path: str) -> Optional[str]:
         """Extract text from PDF or TXT file (sync version)"""
@@ -56,52 +109,117 @@ class FileService:
             if file_ext == '.txt':
                 return self._extract_text_from_txt_sync(file_path)
             elif file_ext == '.pdf':
-                return self._extract_text_from_pdf_sync(file_path)
+                return self._extract_text_from_pdf_cached(file_path)
             else:
                 raise ValueError(f"Unsupported file type: {file_ext}")
                 
         except Exception as e:
             raise Exception(f"Failed to extract text: {str(e)}")
     
+    def _text_cache_path(self, file_path: str) -> Path:
+        """Sidecar file holding the extracted text of an uploaded PDF"""
+        return Path(file_path).with_suffix(".txt.cache")
+    
+    def _extract_text_from_pdf_cached(self, file_path: str) -> str:
+        """Extract text from PDF, reusing the sidecar cache if it is up to date"""
+        cache_path = self._text_cache_path(file_path)
+        
+        try:
+            if cache_path.stat().st_mtime >= os.stat(file_path).st_mtime:
+                return cache_path.read_text(encoding='utf-8')
+        except FileNotFoundError:
+            pass
+        
+        text = self._extract_text_from_pdf_sync(file_path)
+        
+        # Write to a temp file first so readers never see a partial cache
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            tmp_path.write_text(text, encoding='utf-8')
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            tmp_path.unlink(missing_ok=True)
+        
+        return text
+    
     def _extract_text_from_txt_sync(self, file_path: str) -> str:
         """Extract text from TXT file (sync version)"""
         with open(file_path, 'r', encoding='utf-8') as f:
             content = f.read()
         return content
     
+    def _pdf_page_ranges(self, file_path: str) -> list[tuple[int, int]]:
+        """Split a PDF's pages into one contiguous range per pool worker"""
+        with pdfplumber.open(file_path) as pdf:
+            page_count = len(pdf.pages)
+        
+        if page_count <= PARALLEL_PDF_MIN_PAGES:
+            return [(0, page_count)]
+        
+        workers = os.cpu_count() or 1
+        size = -(-page_count // workers)  # Ceiling division
+        return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+    
+    def _extract_text_from_pdf_pypdf2(self, file_path: str) -> str:
+        """Extract text from PDF file using PyPDF2"""
+        with open(file_path, 'rb') as file:
+            pdf_reader = PyPDF2.PdfReader(file)
+            text = ""
+            for page in pdf_reader.pages:
+                text += page.extract_text() + "\n"
+        return text
+    
+    def _extract_text_from_pdf_pdfplumber(self, file_path: str) -> str:
+        """Extract text from PDF file using pdfplumber, sharding large files across the pool"""
+        ranges = self._pdf_page_ranges(file_path)
+        if len(ranges) == 1:
+            return _extract_page_range(file_path, *ranges[0])
+        
+        pool = _get_pdf_pool()
+        futures = [pool.submit(_extract_page_range, file_path, start, end) for start, end in ranges]
+        return "".join(future.result() for future in futures)
+    
+    def _extract_text_from_pdf_fitz(self, file_path: str) -> str:
+        """Extract text from PDF file using PyMuPDF"""
+        with fitz.open(file_path) as doc:
+            return "\n".join(page.get_text("text") for page in doc)
+    
     def _extract_text_from_pdf_sync(self, file_path: str) -> str:
-        """Extract text from PDF file using pdfplumber (sync version)"""
-        text = ""
-        try:
-            with pdfplumber.open(file_path) as pdf:
-                for page in pdf.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
-            return text
-        except Exception as e:
-            # Fallback to PyPDF2
+        """Extract text from PDF file using PyMuPDF, falling back to pdfplumber then PyPDF2 (sync version)"""
+        errors = []
+        for backend, extract in (
+            ("PyMuPDF", self._extract_text_from_pdf_fitz),
+            ("pdfplumber", self._extract_text_from_pdf_pdfplumber),
+            ("PyPDF2", self._extract_text_from_pdf_pypdf2),
+        ):
             try:
-                with open(file_path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    text = ""
-                    for page in pdf_reader.pages:
-                        text += page.extract_text() + "\n"
-                return text
-            except Exception as e2:
-                raise Exception(f"Failed with both pdfplumber and PyPDF2: {str(e)}, {str(e2)}")
+                return extract(file_path)
+            except Exception as e:
+                errors.append(f"{backend}: {str(e)}")
+        
+        raise Exception(f"Failed with all PDF backends: {', '.join(errors)}")
+    
+    def count_words(self, text: str) -> int:
+        """Count whitespace-separated words without building a word list"""
+        return sum(1 for _ in re.finditer(r"\S+", text))
     
     def detect_language(self, text: str) -> str:
-        """Simple language detection (sync version)"""
-        # Basic language detection - can be enhanced
-        if not text:
-            return "unknown"
+        """Detect document language with CLD3, falling back to a simple heuristic (sync version)"""
+        if _cld3 is not None:
+            sample = text[:1000] if text else ""
+            if not sample.strip():
+                return "unknown"
+            
+            result = _cld3.FindLanguage(text=sample)
+            return result.language if result.is_reliable else "unknown"
         
         # Simple heuristic - can be replaced with proper language detection
-        english_words = ["the", "and", "or", "but", "in", "on", "at", "to", "for", "of", "with", "by"]
-        words = text.lower().split()[:100]  # Check first 100 words
+        # Only lower/split the head of the document: check first 100 words
+        words = text[:2048].lower().split()[:100] if text else []
+        if not words:
+            return "unknown"
         
-        english_count = sum(1 for word in words if word in english_words)
+        english_count = sum(1 for word in words if word in _EN_WORDS)
         if english_count / len(words) > 0.1:  # If more than 10% are common English words
             return "en"
         
@@ -110,11 +228,14 @@ class FileService:
     def delete_file(self, file_path: str) -> bool:
         """Delete file from disk (sync version)"""
         try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                return True
-            return False
-        except Exception:
+            self._text_cache_path(file_path).unlink(missing_ok=True)
+        except OSError:
+            pass
+        
+        try:
+            os.remove(file_path)
+            return True
+        except OSError:  # Includes FileNotFoundError
             return False
 
     # Keep async versions for compatibility
@@ -140,57 +261,22 @@ class FileService:
         return content
     
     async def _extract_text_from_pdf(self, file_path: str) -> str:
-        """Extract text from PDF file using pdfplumber"""
-        def extract_pdf_sync():
-            text = ""
-            try:
-                with pdfplumber.open(file_path) as pdf:
-                    for page in pdf.pages:
-                        page_text = page.extract_text()
-                        if page_text:
-                            text += page_text + "\n"
-                return text
-            except Exception as e:
-                # Fallback to PyPDF2
-                try:
-                    with open(file_path, 'rb') as file:
-                        pdf_reader = PyPDF2.PdfReader(file)
-                        text = ""
-                        for page in pdf_reader.pages:
-                            text += page.extract_text() + "\n"
-                    return text
-                except Exception as e2:
-                    raise Exception(f"Failed with both pdfplumber and PyPDF2: {str(e)}, {str(e2)}")
-        
-        # Run in thread pool to avoid blocking
-        loop = asyncio.get_event_loop()
-        text = await loop.run_in_executor(None, extract_pdf_sync)
-        return text
+        """Extract text from PDF file using PyMuPDF, falling back to pdfplumber then PyPDF2"""
+        return await asyncio.to_thread(self._extract_text_from_pdf_sync, file_path)
     
     async def detect_language_async(self, text: str) -> str:
         """Simple language detection (async version)"""
-        # Basic language detection - can be enhanced
-        if not text:
-            return "unknown"
-        
-        # Simple heuristic - can be replaced with proper language detection
-        english_words = ["the", "and", "or", "but", "in", "on", "at", "to", "for", "of", "with", "by"]
-        words = text.lower().split()[:100]  # Check first 100 words
-        
-        english_count = sum(1 for word in words if word in english_words)
-        if english_count / len(words) > 0.1:  # If more than 10% are common English words
-            return "en"
-        
-        return "unknown"
+        return self.detect_language(text)
     
     async def delete_file_async(self, file_path: str) -> bool:
         """Delete file from disk (async version)"""
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                return True
-            return False
-        except Exception:
-            return False
+        return await asyncio.to_thread(self.delete_file, file_path)
+
+    def close(self):
+        """Shut down the PDF extraction process pool if it was started"""
+        global _pdf_pool
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(wait=False, cancel_futures=True)
+            _pdf_pool = None
 
 file_service = FileService() 
\ No newline at end of file
@@ -0,0 +1,88 @@
+import logging
+import uuid
+from typing import AsyncIterator, Optional
+import redis.asyncio as aioredis
+from app.config import settings
+from app.schemas import ProgressUpdate
+
+logger = logging.getLogger(__name__)
+
+class ProgressService:
+    """Fan out document processing progress over Redis Pub/Sub"""
+
+    def __init__(self):
+        self.redis_client = aioredis.from_url(settings.redis_url)
+
+    def _channel(self, file_id) -> str:
+        return f"progress:{file_id}"
+
+    def _snapshot_key(self, file_id) -> str:
+        return f"progress_snapshot:{file_id}"
+
+    async def publish(self, progress_update: ProgressUpdate, snapshot_ttl: int = 3600):
+        """Publish a progress update and keep it as the document's latest snapshot"""
+        data = progress_update.model_dump_json()
+
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.set(self._snapshot_key(progress_update.file_id), data, ex=snapshot_ttl)
+                pipe.publish(self._channel(progress_update.file_id), data)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Progress publish error: {e}")
+
+    async def get_snapshot(self, file_id: uuid.UUID) -> Optional[ProgressUpdate]:
+        """Get the latest published progress update for a document"""
+        try:
+            data = await self.redis_client.get(self._snapshot_key(file_id))
+            if data:
+                return ProgressUpdate.model_validate_json(data)
+        except Exception as e:
+            logger.warning(f"Progress snapshot read error: {e}")
+
+        return None
+
+    async def get_snapshots(self, file_ids: list[uuid.UUID]) -> list[Optional[ProgressUpdate]]:
+        """Get the latest published progress updates for several documents in one MGET"""
+        if not file_ids:
+            return []
+
+        try:
+            values = await self.redis_client.mget([self._snapshot_key(file_id) for file_id in file_ids])
+            return [ProgressUpdate.model_validate_json(data) if data else None for data in values]
+        except Exception as e:
+            logger.warning(f"Progress snapshot read error: {e}")
+
+        return [None] * len(file_ids)
+
+    async def subscribe(self, file_id: uuid.UUID) -> AsyncIterator[str]:
+        """Yield progress updates (as JSON) until processing completes"""
+        pubsub = self.redis_client.pubsub()
+        await pubsub.subscribe(self._channel(file_id))
+
+        try:
+            # Processing may have advanced (or finished) before we subscribed
+            snapshot = await self.get_snapshot(file_id)
+            if snapshot:
+                yield snapshot.model_dump_json()
+                if snapshot.status in ("ready", "error"):
+                    return
+
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+
+                update = ProgressUpdate.model_validate_json(message["data"])
+                yield update.model_dump_json()
+
+                # Stop once processing is complete
+                if update.status in ("ready", "error"):
+                    break
+        finally:
+            await pubsub.unsubscribe(self._channel(file_id))
+            await pubsub.aclose()
+
+    async def close(self):
+        await self.redis_client.aclose()
+
+progress_service = ProgressService()
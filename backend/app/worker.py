@@ -0,0 +1,31 @@
+import os
+import uuid
+import logging
+from arq.connections import RedisSettings
+
+from app.config import settings
+from app.database import close_db
+from app.routers.upload import process_document_pipeline
+from app.services.file_service import file_service
+from app.services.progress_service import progress_service
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+
+async def process_document(ctx, file_id: uuid.UUID, file_path: str):
+    """Run the document processing pipeline for an uploaded file"""
+    await process_document_pipeline(file_id, file_path)
+
+async def shutdown(ctx):
+    await close_db()
+    await progress_service.close()
+    file_service.close()
+
+class WorkerSettings:
+    """arq worker: run with `arq app.worker.WorkerSettings`"""
+    functions = [process_document]
+    on_shutdown = shutdown
+    redis_settings = RedisSettings.from_dsn(settings.redis_url)
+    max_jobs = os.cpu_count() or 1
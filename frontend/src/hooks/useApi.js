@@ -74,6 +74,19 @@ export const usePromptTemplate = (templateId) => {
   );
 };
 
+// Fetch a full template (list items only carry a prompt preview)
+export const useFetchPromptTemplate = () => {
+  const queryClient = useQueryClient();
+  
+  return (templateId) => queryClient.fetchQuery(
+    ['promptTemplate', templateId],
+    () => aiApi.getPromptTemplate(templateId),
+    {
+      staleTime: 300000, // 5 minutes
+    }
+  );
+};
+
 export const useCreatePromptTemplate = () => {
   const queryClient = useQueryClient();
   
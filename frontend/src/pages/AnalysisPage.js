@@ -6,6 +6,7 @@ import Editor from '@monaco-editor/react';
 import {
   useDocument,
   usePromptTemplates,
+  useFetchPromptTemplate,
   useAnalyzeDocument,
   useAnalyses
 } from '../hooks/useApi';
@@ -19,13 +20,14 @@ const AnalysisPage = () => {
 
   const { data: document } = useDocument(documentId);
   const { data: templates = [] } = usePromptTemplates();
+  const fetchPromptTemplate = useFetchPromptTemplate();
   const { data: analyses = [] } = useAnalyses(documentId);
   const analyzeMutation = useAnalyzeDocument();
 
-  const handleTemplateSelect = (templateId) => {
+  const handleTemplateSelect = async (templateId) => {
     setSelectedTemplate(templateId);
-    const template = templates.find(t => t.id === templateId);
-    if (template) {
+    if (templateId) {
+      const template = await fetchPromptTemplate(templateId);
       setCustomPrompt(template.prompt_text.replace('{document_content}', '{document_content}'));
     }
   };
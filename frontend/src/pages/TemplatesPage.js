@@ -3,6 +3,7 @@ import { Plus, Edit, Trash2, Copy } from 'lucide-react';
 import Editor from '@monaco-editor/react';
 import {
   usePromptTemplates,
+  useFetchPromptTemplate,
   useCreatePromptTemplate,
   useUpdatePromptTemplate,
   useDeletePromptTemplate,
@@ -21,6 +22,7 @@ const TemplatesPage = () => {
   });
 
   const { data: templates = [], isLoading } = usePromptTemplates();
+  const fetchPromptTemplate = useFetchPromptTemplate();
   const createMutation = useCreatePromptTemplate();
   const updateMutation = useUpdatePromptTemplate();
   const deleteMutation = useDeletePromptTemplate();
@@ -50,7 +52,8 @@ const TemplatesPage = () => {
     }
   };
 
-  const handleEdit = (template) => {
+  const handleEdit = async (summary) => {
+    const template = await fetchPromptTemplate(summary.id);
     setEditingTemplate(template);
     setFormData({
       name: template.name,
@@ -72,7 +75,8 @@ const TemplatesPage = () => {
     }
   };
 
-  const handleCopy = (template) => {
+  const handleCopy = async (summary) => {
+    const template = await fetchPromptTemplate(summary.id);
     navigator.clipboard.writeText(template.prompt_text);
   };
 
@@ -172,8 +176,8 @@ const TemplatesPage = () => {
               <p className="text-xs text-gray-500 mb-2">Prompt Preview:</p>
               <div className="bg-gray-50 rounded p-3 text-sm">
                 <code className="text-gray-700">
-                  {template.prompt_text.substring(0, 150)}
-                  {template.prompt_text.length > 150 ? '...' : ''}
+                  {template.prompt_preview.substring(0, 150)}
+                  {template.prompt_preview.length > 150 ? '...' : ''}
                 </code>
               </div>
             </div>